@@ -13,6 +13,7 @@ from src.config.settings import settings
 from src.data_layer.database_manager import DatabaseManager
 from src.services.pipeline.resource_provider import ResourceProvider
 from src.services.dag_renderer import generate_dag_image
+from src.services.langgraph_builder import YAML_LOADER
 from src.services.workflow_orchestrator import run_workflow_streaming
 from src.domain.workflow_schema import WorkflowDefinition
 from src.domain.lifecycle import StepLifecycle
@@ -22,7 +23,12 @@ from src.domain.lifecycle import StepLifecycle
 @st.cache_resource
 def initialize_base_resources():
     """Initializes and caches heavy resources like the DB manager."""
-    return ResourceProvider(db_manager=DatabaseManager(settings.mongo_uri))
+    return ResourceProvider(
+        db_manager=DatabaseManager(settings.mongo_uri),
+        max_concurrent_llm=settings.max_concurrent_llm,
+        llm_batch_delay_s=settings.llm_batch_delay_s,
+        debug_enabled=settings.debug_enabled,
+    )
 
 @st.cache_data
 def get_available_workflows(directory: str) -> Dict[str, Path]:
@@ -34,11 +40,14 @@ def get_available_workflows(directory: str) -> Dict[str, Path]:
         workflows[f.parent.name.replace("_", " ").title()] = f
     return workflows
 
-@st.cache_data
 def load_workflow_content(workflow_path: Path) -> Tuple[dict, str]:
-    """Loads and caches a workflow YAML file and its raw content."""
+    """Loads a workflow YAML file and its raw content, cached until the file changes."""
+    return _load_workflow_content(workflow_path, workflow_path.stat().st_mtime_ns)
+
+@st.cache_data
+def _load_workflow_content(workflow_path: Path, mtime_ns: int) -> Tuple[dict, str]:
     with open(workflow_path, 'r') as f: content = f.read()
-    return yaml.safe_load(content), content
+    return yaml.load(content, Loader=YAML_LOADER), content
 
 def run_async(coro):
     """Runs an async coroutine from a sync context."""
@@ -90,15 +99,16 @@ def display_debug_log(workflow_def: dict):
         if status == "Completed": color = "green"
         elif status == "Running": color = "orange"
         elif status == "Failed": color = "red"
-        with st.expander(f":{color}[●] **{step_name}** (`{record.get('type')}`) - {record.get('duration_ms', 0):.2f} ms"):
+        with st.expander(f":{color}[●] **{step_name}** (`{record.get('type')}`) - {record.get('duration_ns', 0) / 1e6:.2f} ms"):
             st.subheader("Summary Data Flow")
             colA, colB = st.columns(2)
             colA.markdown("**Inputs**"); colA.json(record.get('inputs', {})); colB.markdown("**Outputs**"); colB.json(record.get('outputs', {}))
             if log_group['children']:
-                st.subheader("Parallel Executions")
+                st.subheader("Child Executions")
                 for child_record in sorted(log_group['children'], key=lambda c: c['step_name']):
                     with st.container(border=True):
-                        st.markdown(f"**{child_record['step_name']}**")
+                        cached_note = " :blue[(served from cache, no call made)]" if child_record.get('status') == "Cached" else ""
+                        st.markdown(f"**{child_record['step_name']}**{cached_note}")
                         c_colA, c_colB = st.columns(2)
                         c_colA.markdown("**Inputs**"); c_colA.json(child_record.get('inputs', {}))
                         c_colB.markdown("**Outputs**"); c_colB.json(child_record.get('outputs', {}))
@@ -118,11 +128,10 @@ async def execute_workflow(resources: ResourceProvider, workflow_def: WorkflowDe
         async for event in run_workflow_streaming(resources, workflow_dict, workflow_path, full_initial_state):
             if event["type"] == "lifecycle_update":
                 update_data = event["data"]; st.session_state.step_lifecycle[update_data["step_name"]] = update_data["status"]
-                dag_placeholder.graphviz_chart(generate_dag_image(workflow_dict, st.session_state.step_lifecycle)); await asyncio.sleep(0.01)
+                dag_placeholder.graphviz_chart(generate_dag_image(workflow_dict, st.session_state.step_lifecycle))
             elif event["type"] == "log":
                 record = event["data"]; st.session_state.debug_records.append(record)
                 with log_placeholder.container(): display_debug_log(workflow_dict)
-                await asyncio.sleep(0.01)
             elif event["type"] == "sub_workflow_event":
                 data = event["data"]; parent_step, sub_workflow_name, map_index = data["parent_step"], data["sub_workflow"], data["map_index"]
                 original_event = data["original_event"]
@@ -134,14 +143,17 @@ async def execute_workflow(resources: ResourceProvider, workflow_def: WorkflowDe
                     expander_title = f"Sub-Workflow: `{parent_step}` (`{sub_workflow_name}`)"
                     if map_index is not None: expander_title += f" [Run {map_index + 1}]"
                     expander = sub_dag_area.expander(expander_title, expanded=True)
-                    st.session_state.sub_dags[sub_dag_key] = {"dict": sub_workflow_dict, "lifecycle": {name: StepLifecycle.PENDING.value for name in sub_step_names}, "placeholder": expander.empty()}
+                    sub_router_names = {step['name'] for step in sub_workflow_dict.get('steps', []) if step.get('type') == 'conditional_router'}
+                    st.session_state.sub_dags[sub_dag_key] = {"dict": sub_workflow_dict, "lifecycle": {name: StepLifecycle.PENDING.value for name in sub_step_names}, "routers": sub_router_names, "placeholder": expander.empty()}
                 sub_dag_state = st.session_state.sub_dags[sub_dag_key]; event_type = original_event["event"]
                 if event_type == "on_chain_start" and original_event["name"] != "__root__": sub_dag_state["lifecycle"][original_event["name"]] = "RUNNING"
-                elif event_type == "on_chain_end":
-                    node_output = original_event["data"].get("output", {})
-                    if "debug_log" in node_output and node_output["debug_log"]:
-                        log_data = node_output["debug_log"][0]; sub_dag_state["lifecycle"][log_data["step_name"]] = log_data["status"].upper()
-                sub_dag_state["placeholder"].graphviz_chart(generate_dag_image(sub_dag_state["dict"], sub_dag_state["lifecycle"])); await asyncio.sleep(0.01)
+                elif event_type == "on_chain_end" and original_event["name"] in sub_dag_state["lifecycle"]:
+                    node_name, node_output = original_event["name"], original_event["data"].get("output")
+                    if not isinstance(node_output, dict): node_output = {}
+                    # Routers write nothing but ran; steps skipped after a failure stay PENDING.
+                    if node_output.get("error_info"): sub_dag_state["lifecycle"][node_name] = "FAILED"
+                    elif node_name in sub_dag_state["routers"] or "workflow_data" in node_output or "debug_log" in node_output: sub_dag_state["lifecycle"][node_name] = "COMPLETED"
+                sub_dag_state["placeholder"].graphviz_chart(generate_dag_image(sub_dag_state["dict"], sub_dag_state["lifecycle"]))
             elif event["type"] == "result":
                 st.session_state.last_run_state = event["data"]
                 if event["data"].get("error_info"): status.update(label="Workflow failed!", state="error")
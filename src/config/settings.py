@@ -10,5 +10,8 @@ class Settings(BaseSettings):
     )
 
     mongo_uri: str = Field(..., alias='MONGO_URI')
+    max_concurrent_llm: int = Field(32, alias='MAX_CONCURRENT_LLM')
+    llm_batch_delay_s: float = Field(0.0, alias='LLM_BATCH_DELAY_S')
+    debug_enabled: bool = Field(True, alias='DEBUG_ENABLED')
 
 settings = Settings()
\ No newline at end of file
@@ -13,11 +13,17 @@ class BaseCustomStep(ABC):
     # These MUST be defined in the subclass.
     InputModel: Type[BaseModel]
     OutputModel: Type[BaseModel]
+    # A single instance serves every execution of a step. Subclasses that keep
+    # per-execution state on `self` set this to True to get a fresh instance per call.
+    PER_CALL_STATE: bool = False
 
     def __init__(self, resources: ResourceProvider):
         self.resources = resources
 
     @abstractmethod
     async def execute(self, input_data: BaseModel) -> BaseModel:
-        """The core logic of the step lives here."""
+        """
+        The core logic of the step lives here. Steps without any I/O may define
+        it as a plain `def`; it is then called directly instead of awaited.
+        """
         pass
\ No newline at end of file
@@ -8,7 +8,7 @@ class ExtractImageMetadataInput(BaseModel):
     image_file: Dict[str, Any]
 
 class ExtractImageMetadataOutput(BaseModel):
-    size_kb: float = Field(..., description="The size of the image in kilobytes.")
+    size_bytes: int = Field(..., description="The size of the image in bytes.")
     mime_type: str = Field(..., description="The MIME type of the image file.")
 
 class ExtractImageMetadataStep(BaseCustomStep):
@@ -18,11 +18,9 @@ class ExtractImageMetadataStep(BaseCustomStep):
 
     async def execute(self, input_data: ExtractImageMetadataInput) -> ExtractImageMetadataOutput:
         image_data = input_data.image_file
-        
-        byte_data = image_data.get("data", b"")
-        size_in_kb = len(byte_data) / 1024.0
+        byte_data = image_data.get("data")
         
         return ExtractImageMetadataOutput(
-            size_kb=round(size_in_kb, 2),
+            size_bytes=len(byte_data) if byte_data else 0,
             mime_type=image_data.get("mime_type", "unknown")
         )
\ No newline at end of file
@@ -7,6 +7,10 @@ class WorkflowInput(BaseModel):
     label: str
     default: Any = None
 
+class ParallelPrompt(BaseModel):
+    prompt_template: str
+    input_mapping: Dict[str, str] = Field(default_factory=dict)
+
 class StepParams(BaseModel):
     # Common
     output_key: Optional[str] = None
@@ -29,6 +33,15 @@ class StepParams(BaseModel):
     # --- NEW: Dynamic Mapping ---
     map_input: Optional[str] = None
 
+    # --- NEW: Skip Input Validation (code steps) ---
+    trusted_input: bool = False
+
+    # --- NEW: Concurrent Prompts (llm steps) ---
+    parallel_prompts: Optional[List[ParallelPrompt]] = None
+
+    # --- NEW: Result Memoization (llm, code and workflow steps) ---
+    cache_policy: Literal["never", "by_hash"] = "never"
+
 class WorkflowStep(BaseModel):
     name: str
     # --- NEW: Added 'conditional_router' ---
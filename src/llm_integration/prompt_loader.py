@@ -1,40 +1,57 @@
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 import re
+from functools import lru_cache
 from pathlib import Path
 
-def load_prompt_template(filename: str, replacements: Dict[str, Any], base_path: Path) -> str:
+_PLACEHOLDER_RE = re.compile(r'<([^>]+)>')
+
+def compile_prompt_template(filename: str, base_path: Path) -> Tuple[str, ...]:
     """
-    Loads a prompt template, first checking the workflow's local 'prompts'
-    directory, and falling back to a central 'shared_prompts' directory.
+    Locates and parses a prompt template once, returning its segments so that
+    callers can render it repeatedly with render_prompt_template.
     """
-    local_prompt_path = base_path / "prompts" / filename
-    
+    prompt_file_path = _find_prompt_file(filename, base_path)
+    return _parse_prompt_file(prompt_file_path, prompt_file_path.stat().st_mtime_ns)
+
+def prompt_file_candidates(filename: str, base_path: Path) -> Tuple[Path, Path]:
+    """Returns the local and shared paths a prompt filename may resolve to, in lookup order."""
     # The shared directory is located alongside the main 'workflows' directory.
-    shared_prompt_path = base_path.parent.parent / "shared_prompts" / filename
+    return base_path / "prompts" / filename, base_path.parent.parent / "shared_prompts" / filename
+
+def _find_prompt_file(filename: str, base_path: Path) -> Path:
+    """Resolves a prompt filename to the local or shared prompt file that exists."""
+    local_prompt_path, shared_prompt_path = prompt_file_candidates(filename, base_path)
 
-    prompt_file_path = None
     if local_prompt_path.exists():
-        prompt_file_path = local_prompt_path
-    elif shared_prompt_path.exists():
-        prompt_file_path = shared_prompt_path
-    else:
-        raise FileNotFoundError(
-            f"Prompt template '{filename}' not found. Searched in:\n"
-            f"- Local: {local_prompt_path}\n"
-            f"- Shared: {shared_prompt_path}"
-        )
+        return local_prompt_path
+    if shared_prompt_path.exists():
+        return shared_prompt_path
+    raise FileNotFoundError(
+        f"Prompt template '{filename}' not found. Searched in:\n"
+        f"- Local: {local_prompt_path}\n"
+        f"- Shared: {shared_prompt_path}"
+    )
 
+@lru_cache(maxsize=256)
+def _parse_prompt_file(prompt_file_path: Path, mtime_ns: int) -> Tuple[str, ...]:
+    """
+    Reads a prompt file and splits it into alternating literal and placeholder
+    segments. Cached per modification time, so edited prompts are re-read.
+    """
     try:
-        with open(prompt_file_path, "r") as f:
-            template = f.read()
+        template = prompt_file_path.read_text(encoding="utf-8")
     except Exception as e:
         raise IOError(f"Failed to read prompt file at {prompt_file_path}: {e}")
+    return tuple(_PLACEHOLDER_RE.split(template))
 
-    for key, value in replacements.items():
-        template = template.replace(f"<{key}>", str(value))
-
-    missed = re.findall(r'<([^>]+)>', template)
+def render_prompt_template(segments: Tuple[str, ...], replacements: Dict[str, Any], filename: str) -> str:
+    """Fills the placeholder segments of a compiled template from the replacements."""
+    placeholders = segments[1::2]
+    missed = [p for p in placeholders if p not in replacements]
     if missed:
         raise ValueError(f"Missing replacements for placeholders in {filename}: {missed}")
 
-    return template
\ No newline at end of file
+    parts = [segments[0]]
+    for i in range(1, len(segments), 2):
+        parts.append(str(replacements[segments[i]])); parts.append(segments[i + 1])
+    return "".join(parts)
\ No newline at end of file
@@ -1,5 +1,7 @@
+import json
 import graphviz
-from typing import Dict, Any, Optional
+from functools import lru_cache
+from typing import Dict, Any, Optional, Tuple
 
 LIFECYCLE_COLORS = {
     "PENDING": "#5b5b5b", "RUNNING": "#d5a43d",
@@ -7,6 +9,32 @@ LIFECYCLE_COLORS = {
 }
 
 def generate_dag_image(workflow_def: Dict[str, Any], step_states: Optional[Dict[str, str]] = None):
+    """
+    Returns the Graphviz DAG for a workflow, colored by the given step states.
+    Both the uncolored structure and each colored variant are memoized, so
+    repeated UI refreshes with unchanged inputs are a cache lookup.
+    """
+    workflow_json = json.dumps(workflow_def, sort_keys=True, default=str)
+    states_key = tuple(sorted(step_states.items())) if step_states else None
+    return _render_dag(workflow_json, states_key).copy()
+
+@lru_cache(maxsize=256)
+def _render_dag(workflow_json: str, states_key: Optional[Tuple[Tuple[str, str], ...]]) -> graphviz.Digraph:
+    """Applies lifecycle colors on top of a copy of the cached base DAG."""
+    dot = _build_base_dag(workflow_json).copy()
+    if states_key is None: return dot
+
+    step_states = dict(states_key)
+    # Re-declaring a node in DOT only overrides the given attributes.
+    for step in json.loads(workflow_json).get('steps', []):
+        current_state = step_states.get(step['name'], "PENDING")
+        dot.node(step['name'], fillcolor=LIFECYCLE_COLORS.get(current_state, LIFECYCLE_COLORS["DEFAULT"]))
+    return dot
+
+@lru_cache(maxsize=64)
+def _build_base_dag(workflow_json: str) -> graphviz.Digraph:
+    """Builds the nodes and edges of a workflow DAG, without any lifecycle state."""
+    workflow_def = json.loads(workflow_json)
     dot = graphviz.Digraph(comment='Workflow DAG')
     dot.attr('graph', bgcolor='transparent', rankdir='LR')
     dot.attr('node', style='rounded,filled', fontcolor='white')
@@ -17,22 +45,22 @@ def generate_dag_image(workflow_def: Dict[str, Any], step_states: Optional[Dict[
 
     dot.node('__start__', 'START', shape='ellipse', style='filled', fillcolor=LIFECYCLE_COLORS["PENDING"])
 
-    output_to_step_map = {
-        step['params']['output_key']: step['name']
-        for step in steps if step.get('params', {}).get('output_key')
-    }
-    output_to_step_map.update({
-        out_key: step['name'] for step in steps if step['type'] == 'workflow'
-        for out_key in step['params'].get('output_mapping', {}).values()
-    })
-
-    router_targets = {target for s in steps if s['type'] == 'conditional_router' for target in s.get('params', {}).get('routing_map', {}).values()}
+    # Collect the name lookup, output producers and router targets in one pass.
+    steps_by_name, output_to_step_map, router_targets = {}, {}, set()
+    for step in steps:
+        step_name, step_type, params = step['name'], step['type'], step.get('params') or {}
+        steps_by_name[step_name] = step
+        output_key = params.get('output_key')
+        if output_key: output_to_step_map[output_key] = step_name
+        if step_type == 'workflow':
+            for out_key in params.get('output_mapping', {}).values(): output_to_step_map[out_key] = step_name
+        elif step_type == 'conditional_router':
+            router_targets.update(params.get('routing_map', {}).values())
 
     for step in steps:
         step_name, step_type, params = step['name'], step['type'], step.get('params', {})
-        current_state = step_states.get(step_name, "PENDING") if step_states else "DEFAULT"
         border_color = LIFECYCLE_COLORS["COMPLETED"]
-        fill_color = LIFECYCLE_COLORS.get(current_state, LIFECYCLE_COLORS["DEFAULT"])
+        fill_color = LIFECYCLE_COLORS["DEFAULT"]
         node_label = f"{step_name}\n({step_type})"
         if params.get('map_input'): node_label += " 🔁"
         if step_type == "workflow":
@@ -51,7 +79,7 @@ def generate_dag_image(workflow_def: Dict[str, Any], step_states: Optional[Dict[
             for dep_key in dependencies:
                 source_step_name = output_to_step_map.get(dep_key)
                 if source_step_name:
-                    source_step_params = next((s['params'] for s in steps if s['name'] == source_step_name), {})
+                    source_step_params = steps_by_name[source_step_name].get('params', {})
                     edge_label = "[list]" if source_step_params.get('map_input') == dep_key else ""
                     dot.edge(source_step_name, step_name, label=edge_label)
 
@@ -1,49 +1,217 @@
-import re
 import operator
-from typing import TypedDict, List, Dict, Any, Annotated
+from operator import methodcaller
+from functools import lru_cache
+from dataclasses import dataclass, field, fields
+from typing import List, Dict, Any, Annotated, Optional, Callable, Tuple, get_type_hints
 
 # --- SHARED TYPE DEFINITIONS ---
 
 def merge_workflow_data(left: dict, right: dict) -> dict:
-    """Merges two dictionaries, concatenating list values."""
-    return {**left, **right}
+    """
+    Merges a node's workflow_data update into the current data. Keys in the
+    update overwrite existing ones, matching output_key semantics.
 
-class GraphState(TypedDict):
-    """The central state representation for all workflows."""
-    execution_log: Annotated[List[str], operator.add]
-    debug_log: Annotated[List[Dict[str, Any]], operator.add]
-    error_info: Annotated[List[Dict[str, Any]], operator.add]
-    workflow_data: Annotated[dict, merge_workflow_data]
+    The accumulator is updated in place. It is only ever a dict this reducer
+    allocated: the first non-empty update is copied, so neither the run's
+    initial input nor a node's returned outputs are ever mutated.
+    """
+    if not right: return left
+    if not left: return right.copy()
+    left.update(right)
+    return left
+
+# Upper bound on the log records kept in graph state; the UI receives every
+# record as it is streamed, so only the most recent ones need to stay in state.
+MAX_LOG_RECORDS = 1000
+
+def append_bounded(left: list, right: list) -> list:
+    """
+    Appends log records, keeping only the most recent MAX_LOG_RECORDS. Like
+    merge_workflow_data, the accumulator is extended in place once the first
+    update has been copied into a list owned by the reducer.
+    """
+    if not right: return left
+    if not left: return list(right[-MAX_LOG_RECORDS:])
+    left.extend(right)
+    if len(left) > MAX_LOG_RECORDS: del left[:-MAX_LOG_RECORDS]
+    return left
+
+@dataclass(slots=True)
+class DebugRecord:
+    """A single step execution as recorded in the debug log."""
+    step_name: str
+    type: str
+    status: str
+    duration_ns: int
+    inputs: Any
+    outputs: Any
+    error: Optional[Dict[str, Any]] = None
+    is_child: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a shallow dict of the record for display, omitting unset optional fields."""
+        record = {"step_name": self.step_name, "type": self.type, "status": self.status, "duration_ns": self.duration_ns, "inputs": self.inputs, "outputs": self.outputs}
+        if self.error is not None: record["error"] = self.error
+        if self.is_child: record["is_child"] = True
+        return record
+
+@dataclass(slots=True)
+class GraphState:
+    """
+    The central state representation for all workflows. Nodes read it through
+    attributes and return plain dicts of updates; graph inputs and outputs
+    remain dicts.
+    """
+    execution_log: Annotated[List[str], append_bounded] = field(default_factory=list)
+    debug_log: Annotated[List[DebugRecord], append_bounded] = field(default_factory=list)
+    error_info: Annotated[List[Dict[str, Any]], operator.add] = field(default_factory=list)
+    workflow_data: Annotated[dict, merge_workflow_data] = field(default_factory=dict)
+
+# The reducer of each GraphState field, as declared in its annotation.
+STATE_REDUCERS: Dict[str, Callable[[Any, Any], Any]] = {
+    name: hint.__metadata__[0] for name, hint in get_type_hints(GraphState, include_extras=True).items()
+}
+
+def empty_state() -> Dict[str, Any]:
+    """Returns a GraphState's default field values as a plain dict."""
+    return {f.name: f.default_factory() for f in fields(GraphState)}
+
+def apply_state_update(state: Dict[str, Any], update: Dict[str, Any]) -> None:
+    """
+    Folds an input or a node's update into a plain-dict state through the same
+    reducers the graph applies, so the final state can be rebuilt from the
+    streamed updates alone.
+    """
+    for key, value in update.items():
+        reducer = STATE_REDUCERS.get(key)
+        state[key] = reducer(state[key], value) if reducer else value
 
 # --- SHARED HELPER FUNCTIONS ---
 
+def _contains_bytes(data: Any) -> bool:
+    """Returns True as soon as any bytes value is found in nested dicts and lists."""
+    stack, seen = [data], set()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, bytes): return True
+        if isinstance(value, (dict, list)):
+            if id(value) in seen: continue
+            seen.add(id(value))
+            stack.extend(value.values() if isinstance(value, dict) else value)
+    return False
+
 def sanitize_for_json(data: Any) -> Any:
-    """Recursively sanitizes data to be JSON-serializable."""
+    """
+    Sanitizes data to be JSON-serializable, walking nested dicts and lists with
+    an explicit stack instead of recursion. Data without any bytes is returned
+    as-is; otherwise containers reached more than once (shared or circular
+    references) reuse their sanitized copy.
+    """
+    if not _contains_bytes(data): return data
+    holder = [data]
+    stack = [(data, holder, 0)]
+    copies: Dict[int, Any] = {}
+    while stack:
+        value, parent, key = stack.pop()
+        value_type = type(value)
+        if value_type is dict or value_type is list:
+            copy = copies.get(id(value))
+            if copy is None:
+                if value_type is dict:
+                    copy = dict.fromkeys(value); children = value.items()
+                else:
+                    copy = [None] * len(value); children = enumerate(value)
+                copies[id(value)] = copy
+                stack.extend((child, copy, child_key) for child_key, child in children)
+            parent[key] = copy
+        elif value_type is bytes: parent[key] = f"<bytes of length {len(value)}>"
+        elif isinstance(value, (dict, list, bytes)): parent[key] = _sanitize_slow(value)
+        else: parent[key] = value
+    return holder[0]
+
+def _sanitize_slow(data: Any) -> Any:
+    """Recursive fallback of sanitize_for_json for dict, list and bytes subclasses."""
     if isinstance(data, dict): return {k: sanitize_for_json(v) for k, v in data.items()}
     if isinstance(data, list): return [sanitize_for_json(v) for v in data]
     if isinstance(data, bytes): return f"<bytes of length {len(data)}>"
     return data
 
-def _resolve_value_from_state(state_data: Dict[str, Any], key_string: str) -> Any:
-    """Recursively fetches a value from a nested dictionary using a dot-separated key string."""
-    if key_string == "item": return state_data.get("item")
-    if '.' in key_string:
-        parent_key, child_key = key_string.split('.', 1)
-        parent_value = state_data.get(parent_key)
-        if isinstance(parent_value, dict):
-            return _resolve_value_from_state(parent_value, child_key)
-        return None
+@lru_cache(maxsize=4096)
+def _compile_key(key_string: str) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Compiles a key string into a resolver: a 'quoted' literal is returned as-is,
+    otherwise the dot-separated path is split once and walked through nested
+    dicts, yielding None when it leaves them. Resolvers are cached per key.
+    """
     if key_string.startswith("'") and key_string.endswith("'"):
-        return key_string[1:-1]
-    return state_data.get(key_string)
-
-def _resolve_placeholders(data_structure: Any, state_data: Dict[str, Any]) -> Any:
-    """Recursively finds and replaces <placeholder> strings in a data structure."""
-    if isinstance(data_structure, dict): return {k: _resolve_placeholders(v, state_data) for k, v in data_structure.items()}
-    if isinstance(data_structure, list): return [_resolve_placeholders(v, state_data) for v in data_structure]
-    if isinstance(data_structure, str):
-        for match in re.finditer(r'<([^>]+)>', data_structure):
-            placeholder = match.group(1); resolved_value = _resolve_value_from_state(state_data, placeholder)
-            if data_structure == f"<{placeholder}>": return resolved_value
-            data_structure = data_structure.replace(f"<{placeholder}>", str(resolved_value))
-    return data_structure
\ No newline at end of file
+        literal = key_string[1:-1]
+        return lambda state_data: literal
+    path = tuple(key_string.split('.'))
+    # State data is always a dict, so a flat key is a single C-level dict.get.
+    if len(path) == 1: return methodcaller('get', path[0])
+    def resolve(state_data: Dict[str, Any]) -> Any:
+        value = state_data
+        for key in path:
+            if not isinstance(value, dict): return None
+            value = value.get(key)
+        return value
+    return resolve
+
+def _compile_input_mapping(mapping: Dict[str, str]) -> Tuple[Tuple[str, Callable[[Dict[str, Any]], Any]], ...]:
+    """Compiles a {destination: key_string} mapping into (destination, resolver) pairs."""
+    return tuple((dest, _compile_key(key_string)) for dest, key_string in mapping.items())
+
+@lru_cache(maxsize=4096)
+def _split_placeholders(template: str) -> tuple:
+    """
+    Splits a string into alternating literal and placeholder-name segments,
+    e.g. ('a ', 'x', ' b'), in a single scan with str.find. An empty '<>' is
+    literal text, matching the pattern <([^>]+)> used for prompt templates.
+    """
+    segments, start, search_from = [], 0, 0
+    while True:
+        open_at = template.find('<', search_from)
+        if open_at < 0: break
+        close_at = template.find('>', open_at + 1)
+        # Without a later '>' no further placeholder can follow.
+        if close_at < 0: break
+        if close_at == open_at + 1:
+            search_from = open_at + 1
+            continue
+        segments.append(template[start:open_at]); segments.append(template[open_at + 1:close_at])
+        start = search_from = close_at + 1
+    segments.append(template[start:])
+    return tuple(segments)
+
+def _compile_placeholders(data_structure: Any) -> Optional[Callable[[Dict[str, Any]], Any]]:
+    """
+    Compiles a static data structure into a resolver that replaces its
+    <placeholder> strings with values from the state data, or returns None
+    when it contains no placeholders.
+
+    Only the dict entries and list items that contain placeholders are resolved
+    on each call; everything else is taken from the original structure, which
+    is never mutated.
+    """
+    if isinstance(data_structure, (dict, list)):
+        items = data_structure.items() if isinstance(data_structure, dict) else enumerate(data_structure)
+        dynamic = tuple((key, resolve) for key, value in items if (resolve := _compile_placeholders(value)) is not None)
+        if not dynamic: return None
+        copy = dict if isinstance(data_structure, dict) else list
+        def resolve_container(state_data: Dict[str, Any]) -> Any:
+            resolved = copy(data_structure)
+            for key, resolve in dynamic: resolved[key] = resolve(state_data)
+            return resolved
+        return resolve_container
+    if not isinstance(data_structure, str) or '<' not in data_structure: return None
+    segments = _split_placeholders(data_structure)
+    if len(segments) == 1: return None
+    # A string that is exactly one placeholder keeps the resolved value's type.
+    if len(segments) == 3 and not segments[0] and not segments[2]: return _compile_key(segments[1])
+    literals, resolvers = segments[0::2], tuple(_compile_key(name) for name in segments[1::2])
+    def resolve_string(state_data: Dict[str, Any]) -> str:
+        parts = [literals[0]]
+        for resolve, literal in zip(resolvers, literals[1:]):
+            parts.append(str(resolve(state_data))); parts.append(literal)
+        return "".join(parts)
+    return resolve_string
\ No newline at end of file
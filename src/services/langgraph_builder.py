@@ -1,15 +1,125 @@
+import sys
+import hashlib
+import threading
+from functools import lru_cache
+import yaml
+import orjson
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 from langgraph.graph import StateGraph, START, END
 from langchain_core.runnables import Runnable
 
+from src.llm_integration.prompt_loader import prompt_file_candidates
 from .pipeline.resource_provider import ResourceProvider
 from .node_factory import create_node_function
-from .graph_types import GraphState, _resolve_value_from_state
+from .graph_types import GraphState, _compile_key
 
 # This is now only used for sub-workflow compilation, keeping it scoped here.
-COMPILED_WORKFLOW_CACHE: Dict[str, Runnable] = {}
+# Keyed by (workflow name, content hash of its YAML, fingerprint of the files it
+# reads): identical content hits the cache regardless of file timestamps, while
+# any edit to the YAML, its prompts or its nested sub-workflows is recompiled.
+COMPILED_WORKFLOW_CACHE: Dict[Tuple[str, str, tuple], Runnable] = {}
+MAX_COMPILED_WORKFLOWS = 64
+# Builds run in worker threads and concurrent sessions, so every read, eviction
+# and insert on the compiled-graph caches holds this lock. Graphs are built
+# outside it, since a build compiles its sub-workflows through the same caches.
+_CACHE_LOCK = threading.Lock()
+# The libyaml C loader is used when PyYAML was built with it.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def _definition_references(workflow_def: dict) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Returns the prompt templates and the sub-workflow names a workflow definition references."""
+    prompts, sub_workflows = [], []
+    for step in workflow_def.get('steps', []):
+        params = step.get('params') or {}
+        if params.get('prompt_template'): prompts.append(params['prompt_template'])
+        prompts.extend(p['prompt_template'] for p in params.get('parallel_prompts') or [])
+        if step.get('type') == 'workflow' and params.get('workflow_name'): sub_workflows.append(params['workflow_name'])
+    return tuple(prompts), tuple(sub_workflows)
+
+@lru_cache(maxsize=256)
+def _yaml_references(content: bytes) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Parses workflow YAML once per distinct content and returns its references."""
+    return _definition_references(yaml.load(content, Loader=YAML_LOADER) or {})
+
+def _content_digest(content: bytes) -> str:
+    """Returns a short content hash used in cache keys."""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+def _file_state(path: Path) -> Tuple[int, int]:
+    """Returns (mtime_ns, size) of a file, or (-1, -1) when it does not exist."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_mtime_ns, stat.st_size
+
+def _sources_fingerprint(workflow_package_path: Path, references: Tuple[Tuple[str, ...], Tuple[str, ...]]) -> tuple:
+    """
+    Fingerprints every file a build of a workflow reads besides its own YAML:
+    each prompt path its steps may resolve to (local and shared, so a new local
+    override is noticed) by (mtime_ns, size), and each embedded sub-workflow's
+    YAML by content digest, together with that sub-workflow's own sources.
+    """
+    entries, visited = [], set()
+    pending = [(workflow_package_path, references)]
+    while pending:
+        package_path, (prompt_names, sub_workflow_names) = pending.pop()
+        for prompt_name in prompt_names:
+            for candidate in prompt_file_candidates(prompt_name, package_path): entries.append((str(candidate), *_file_state(candidate)))
+        for sub_workflow_name in sub_workflow_names:
+            sub_workflow_path = package_path.parent / sub_workflow_name / "workflow.yaml"
+            if not sub_workflow_path.exists():
+                entries.append((str(sub_workflow_path), None)); continue
+            content = sub_workflow_path.read_bytes()
+            entries.append((str(sub_workflow_path), _content_digest(content)))
+            if sub_workflow_path in visited: continue
+            visited.add(sub_workflow_path)
+            pending.append((sub_workflow_path.parent, _yaml_references(content)))
+    return tuple(entries)
+
+def compile_sub_workflow(resources: ResourceProvider, workflow_package_path: Path, workflow_name: str) -> Tuple[Runnable, str]:
+    """
+    Returns the compiled graph of a sibling workflow package, compiling it on
+    first use, together with a digest of everything it was compiled from.
+    """
+    sub_workflow_path = workflow_package_path.parent / workflow_name / "workflow.yaml"
+    if not sub_workflow_path.exists(): raise FileNotFoundError(f"Sub-workflow package '{workflow_name}' not found at: {sub_workflow_path}")
+    content = sub_workflow_path.read_bytes()
+    # The name stays in the key: prompts are resolved relative to the package directory.
+    cache_key = (workflow_name, _content_digest(content), _sources_fingerprint(sub_workflow_path.parent, _yaml_references(content)))
+    with _CACHE_LOCK: sub_graph = COMPILED_WORKFLOW_CACHE.get(cache_key)
+    if sub_graph is None:
+        sub_workflow_dict = yaml.load(content, Loader=YAML_LOADER)
+        sub_graph = LangGraphBuilder(sub_workflow_dict, resources, sub_workflow_path).build()
+        with _CACHE_LOCK:
+            # Drop graphs compiled from older versions of the same package, then the oldest entries.
+            for stale_key in [key for key in COMPILED_WORKFLOW_CACHE if key[0] == workflow_name]: del COMPILED_WORKFLOW_CACHE[stale_key]
+            while len(COMPILED_WORKFLOW_CACHE) >= MAX_COMPILED_WORKFLOWS: del COMPILED_WORKFLOW_CACHE[next(iter(COMPILED_WORKFLOW_CACHE))]
+            COMPILED_WORKFLOW_CACHE[cache_key] = sub_graph
+    # Result caching of the step is keyed on this digest, so prompt edits invalidate it too.
+    return sub_graph, _content_digest(orjson.dumps(cache_key))
+
+# Compiled top-level graphs, reused across runs while neither the definition nor
+# any file fingerprinted by _sources_fingerprint changed.
+_WORKFLOW_GRAPH_CACHE: Dict[tuple, Runnable] = {}
+
+def compile_workflow(resources: ResourceProvider, workflow_def: dict, workflow_path: Path) -> Runnable:
+    """Returns the compiled graph of a top-level workflow, building it only on a cache miss."""
+    definition_digest = _content_digest(orjson.dumps(workflow_def, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS))
+    cache_key = (resources, str(workflow_path), definition_digest, _sources_fingerprint(workflow_path.parent, _definition_references(workflow_def)))
+    with _CACHE_LOCK: graph = _WORKFLOW_GRAPH_CACHE.get(cache_key)
+    if graph is None:
+        graph = LangGraphBuilder(workflow_def, resources, workflow_path).build()
+        with _CACHE_LOCK:
+            while len(_WORKFLOW_GRAPH_CACHE) >= MAX_COMPILED_WORKFLOWS: del _WORKFLOW_GRAPH_CACHE[next(iter(_WORKFLOW_GRAPH_CACHE))]
+            _WORKFLOW_GRAPH_CACHE[cache_key] = graph
+    return graph
+
+def _noop_router(state: GraphState) -> Dict[str, Any]:
+    """Shared node body for routers, which write nothing to the state."""
+    return {}
 
 class LangGraphBuilder:
     def __init__(self, workflow_definition: dict, resources: ResourceProvider, workflow_path: Path):
@@ -17,89 +127,108 @@ class LangGraphBuilder:
         self.resources = resources
         self.workflow_package_path = workflow_path.parent 
         self.graph_builder = StateGraph(GraphState)
-        self.output_to_step_map = self._build_output_map()
-        self.steps_by_name = {step['name']: step for step in self.workflow_def.get('steps', [])}
+        self.output_to_step_map, self.steps_by_name = self._index_steps()
+        self._plan = self._build_plan()
 
-    def _build_output_map(self) -> Dict[str, str]:
-        """Creates a mapping from an output key to the name of the step that produces it."""
-        output_map = {}
+    def _index_steps(self) -> Tuple[Dict[str, str], Dict[str, dict]]:
+        """
+        In a single pass over the steps, interns the step names and state keys
+        (used as dict keys on every node invocation, so lookups compare by
+        identity) and maps each output key to the name of the step producing it.
+        """
+        output_map, steps_by_name = {}, {}
         for step in self.workflow_def.get('steps', []):
-            params = step.get('params', {})
-            if params.get('output_key'): output_map[params['output_key']] = step['name']
+            step['name'] = step_name = sys.intern(step['name'])
+            steps_by_name[step_name] = step
+            step['dependencies'] = [sys.intern(dep) for dep in step.get('dependencies', [])]
+            params = step.get('params') or {}
+            if params.get('output_key'):
+                params['output_key'] = sys.intern(params['output_key'])
+                output_map[params['output_key']] = step_name
+            for mapping_name in ('input_mapping', 'output_mapping'):
+                if params.get(mapping_name):
+                    params[mapping_name] = {sys.intern(k): sys.intern(v) for k, v in params[mapping_name].items()}
             if step['type'] == 'workflow' and params.get('output_mapping'):
-                for out_key in params['output_mapping'].values(): output_map[out_key] = step['name']
-        return output_map
+                for out_key in params['output_mapping'].values(): output_map[out_key] = step_name
+        return output_map, steps_by_name
 
-    def build(self) -> Runnable:
+    @staticmethod
+    def _create_conditional_func(key: str):
+        # The key is compiled once here rather than parsed on every decision.
+        resolve = _compile_key(key)
+        def conditional_func(state: GraphState):
+            return str(resolve(state.workflow_data or {}))
+        return conditional_func
+
+    def _build_plan(self) -> Dict[str, list]:
         """
-        Constructs the LangGraph graph from the workflow definition, now with corrected
-        logic for handling all dependency types, especially fan-in joins.
+        Resolves the static topology of the workflow once: every plain edge,
+        every conditional edge, and the terminal nodes that lead to END.
         """
         steps = self.workflow_def.get('steps', [])
-        
-        # 1. Add all nodes to the graph first.
+
+        # 1. Resolve each step's parent nodes, the targets of routers (which must
+        #    not hang off START) and the nodes that feed another step (which are
+        #    not terminal).
+        parents_by_step: Dict[str, frozenset] = {}
+        router_targets, dependency_sources = set(), set()
         for step in steps:
-            step_name, step_type, step_params = step['name'], step['type'], step.get('params', {})
-            if step_type == 'conditional_router':
-                self.graph_builder.add_node(step_name, lambda state: state)
-            else:
-                node_function = create_node_function(self.resources, self.workflow_package_path, step_name, step_type, step_params)
-                self.graph_builder.add_node(step_name, node_function)
+            step_name = step['name']
+            if step['type'] == 'conditional_router':
+                router_targets.update(step.get('params', {}).get('routing_map', {}).values())
+                # Routers are also dependency sources.
+                dependency_sources.add(step_name)
+            parent_steps = frozenset(self.output_to_step_map[dep] for dep in step.get('dependencies', []) if dep in self.output_to_step_map)
+            parents_by_step[step_name] = parent_steps
+            dependency_sources.update(parent_steps)
 
-        # 2. Identify all nodes that are targets of a router to prevent incorrect START connections.
-        router_targets = {target for s in steps if s['type'] == 'conditional_router' for target in s.get('params', {}).get('routing_map', {}).values()}
-        
-        # 3. Add all edges to the graph.
+        # 2. Resolve every edge.
+        edges: List[Tuple[Any, str]] = []
+        conditional_edges: List[Tuple[str, Any, Dict[str, str]]] = []
         for step in steps:
             step_name = step['name']
-            step_type = step['type']
-            dependencies = step.get('dependencies', [])
+            source_nodes = parents_by_step[step_name]
             
-            if step_type == 'conditional_router':
-                source_nodes = {self.output_to_step_map[dep] for dep in dependencies if dep in self.output_to_step_map}
+            if step['type'] == 'conditional_router':
                 if not source_nodes: raise ValueError(f"Router step '{step_name}' must have dependencies.")
                 # Routers are simple: they depend on their parents finishing, so we connect them directly.
-                self.graph_builder.add_edge(list(source_nodes), step_name)
-                
+                edges.append((list(source_nodes), step_name))
                 params = step.get('params', {})
-                condition_key = params['condition_key']
-                routing_map = params['routing_map']
+                conditional_edges.append((step_name, self._create_conditional_func(params['condition_key']), params['routing_map']))
 
-                def create_conditional_func(key: str):
-                    def conditional_func(state: GraphState):
-                        value = _resolve_value_from_state(state.get("workflow_data", {}), key)
-                        return str(value)
-                    return conditional_func
-                
-                self.graph_builder.add_conditional_edges(step_name, create_conditional_func(condition_key), routing_map)
+            elif not source_nodes:
+                # No dependencies: connect from START if it's not a router target
+                if step_name not in router_targets:
+                    edges.append((START, step_name))
+            else:
+                # One or more dependencies: connect from a list of all parents.
+                # LangGraph handles both single-item lists and multi-item lists correctly,
+                # ensuring it waits for ALL of them before executing the step.
+                edges.append((list(source_nodes), step_name))
+
+        # 3. Connect terminal nodes to the END node. A router itself cannot be a
+        #    terminal node; its paths lead to other nodes or END.
+        edges.extend((node, END) for node in parents_by_step.keys() - dependency_sources)
+        return {"edges": edges, "conditional_edges": conditional_edges}
 
+    def build(self) -> Runnable:
+        """
+        Constructs the LangGraph graph from the workflow definition: every step
+        becomes a node, then the edges of the precomputed plan are added.
+        """
+        for step in self.workflow_def.get('steps', []):
+            step_name, step_type = step['name'], step['type']
+            if step_type == 'conditional_router':
+                # Routers write nothing; the node only acts as the barrier and
+                # branch point, and keeps the router visible in the live DAG.
+                self.graph_builder.add_node(step_name, _noop_router)
             else:
-                # --- THIS IS THE DEFINITIVE FIX FOR THE RACE CONDITION ---
-                source_nodes = {self.output_to_step_map[dep] for dep in dependencies if dep in self.output_to_step_map}
-
-                if not source_nodes:
-                    # No dependencies: connect from START if it's not a router target
-                    if step_name not in router_targets:
-                        self.graph_builder.add_edge(START, step_name)
-                else:
-                    # One or more dependencies: connect from a list of all parents.
-                    # LangGraph handles both single-item lists and multi-item lists correctly,
-                    # ensuring it waits for ALL of them before executing the step.
-                    self.graph_builder.add_edge(list(source_nodes), step_name)
-
-        # 4. Connect terminal nodes to the END node.
-        all_step_names = {s['name'] for s in steps}
-        # A step is a dependency source if another step depends on its output.
-        dependency_sources = {self.output_to_step_map[dep] for s in steps for dep in s.get('dependencies', []) if dep in self.output_to_step_map}
-        # Routers are also dependency sources.
-        for step in steps:
-            if step['type'] == 'conditional_router':
-                dependency_sources.add(step['name'])
-        
-        terminal_nodes = all_step_names - dependency_sources
-        for node in terminal_nodes:
-            # A router itself cannot be a terminal node. Its paths lead to other nodes or END.
-            if self.steps_by_name[node]['type'] != 'conditional_router':
-                self.graph_builder.add_edge(node, END)
+                node_function = create_node_function(self.resources, self.workflow_package_path, step_name, step_type, step.get('params', {}))
+                self.graph_builder.add_node(step_name, node_function)
+
+        for source, target in self._plan["edges"]:
+            self.graph_builder.add_edge(source, target)
+        for source, path, path_map in self._plan["conditional_edges"]:
+            self.graph_builder.add_conditional_edges(source, path, path_map)
         
         return self.graph_builder.compile()
\ No newline at end of file
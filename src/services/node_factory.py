@@ -1,61 +1,77 @@
 import time
+import asyncio
 import traceback
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, Callable
 
-from .graph_types import GraphState, sanitize_for_json
-from .node_logic import _llm_logic, _code_logic, _api_logic, _workflow_logic
+from .graph_types import GraphState, DebugRecord, sanitize_for_json, _compile_key
+from .node_logic import _build_llm_logic, _build_code_logic, _build_api_logic, _build_workflow_logic, _cache_hit_label
+
+def _node_wrapper(step_name: str, step_type: str, params: Dict[str, Any], logic_func: Callable, debug_enabled: bool = True):
+    map_input_key = params.get("map_input")
+    resolve_map_input = _compile_key(map_input_key) if map_input_key else None
 
-def _node_wrapper(step_name: str, step_type: str, params: Dict[str, Any], logic_func: Callable):
     async def wrapped_node(state: GraphState) -> Dict[str, Any]:
-        if state.get("error_info"): return {}
-        start_time = time.perf_counter()
-        outputs, additional_logs, sanitized_inputs = {}, [], {}
+        if state.error_info: return {}
+        start_time = time.perf_counter_ns() if debug_enabled else 0
+        outputs, additional_logs, record_inputs = {}, [], {}
         try:
-            map_input_key = params.get("map_input")
-            workflow_data = state.get("workflow_data", {})
+            workflow_data = state.workflow_data or {}
             
-            if map_input_key:
-                from .graph_types import _resolve_value_from_state
-                import asyncio
-                items_to_process = _resolve_value_from_state(workflow_data, map_input_key)
+            if resolve_map_input:
+                items_to_process = resolve_map_input(workflow_data)
                 if not isinstance(items_to_process, list): raise TypeError(f"Map input '{map_input_key}' must resolve to a list.")
                 
                 async def run_logic_for_item(item, index):
                     context = {**workflow_data, "item": item, "map_index": index}
-                    return await logic_func(item=item, context_data=context)
+                    return await logic_func(context)
                 
                 results_with_details = await asyncio.gather(*(run_logic_for_item(item, i) for i, item in enumerate(items_to_process)))
 
                 detailed_records, aggregated_outputs = [], []
                 for i, (output, inputs, logs) in enumerate(results_with_details):
-                    detailed_records.append({"step_name": f"{step_name} [Run {i+1}/{len(items_to_process)}]", "type": f"mapped_{step_type}", "status": "Completed", "duration_ms": 0, "inputs": inputs, "outputs": output, "is_child": True})
+                    # A cache hit marks the item's own run record instead of adding a second child.
+                    hit_label = _cache_hit_label(step_name, i)
+                    cached = any(log.step_name == hit_label for log in logs)
+                    if cached: logs = [log for log in logs if log.step_name != hit_label]
+                    if debug_enabled: detailed_records.append(DebugRecord(f"{step_name} [Run {i+1}/{len(items_to_process)}]", f"mapped_{step_type}", "Cached" if cached else "Completed", 0, sanitize_for_json(inputs), output, is_child=True))
                     aggregated_outputs.append(output); additional_logs.extend(logs)
                 
                 outputs = {params['output_key']: aggregated_outputs}
-                sanitized_inputs = {"map_source": map_input_key, "item_count": len(items_to_process)}
+                record_inputs = {"map_source": map_input_key, "item_count": len(items_to_process)}
                 additional_logs.extend(detailed_records)
             else:
-                output, resolved_inputs, additional_logs = await logic_func(item=None, context_data=workflow_data)
+                output, resolved_inputs, additional_logs = await logic_func(workflow_data)
                 outputs = {params['output_key']: output} if params.get('output_key') else output
-                sanitized_inputs = sanitize_for_json(resolved_inputs)
+                # Sanitized by the orchestrator when the record is streamed, off the node's path.
+                if debug_enabled: record_inputs = resolved_inputs
 
-            debug_record = {"step_name": step_name, "type": step_type, "status": "Completed", "duration_ms": (time.perf_counter() - start_time) * 1000, "inputs": sanitized_inputs, "outputs": outputs}
-            return {"workflow_data": outputs, "debug_log": [debug_record] + additional_logs}
+            # Without debugging, no record is built at all; the orchestrator
+            # derives lifecycle updates from the node's update itself.
+            if not debug_enabled: return {"workflow_data": outputs}
+            debug_record = DebugRecord(step_name, step_type, "Completed", time.perf_counter_ns() - start_time, record_inputs, outputs)
+            # The logs list is owned by this call, so the record is placed in front without a copy.
+            additional_logs.insert(0, debug_record)
+            return {"workflow_data": outputs, "debug_log": additional_logs}
         except Exception as e:
-            error_details = {"message": str(e), "traceback": traceback.format_exc()}
-            debug_record = {"step_name": step_name, "type": step_type, "status": "Failed", "duration_ms": (time.perf_counter() - start_time) * 1000, "inputs": sanitized_inputs or {"error": "Could not resolve inputs before failure."}, "outputs": {}, "error": error_details}
+            # The traceback is captured without frames or locals, so nothing is pinned
+            # by the graph state, and is only formatted when the record is streamed.
+            error_details = {"message": str(e), "traceback": traceback.TracebackException.from_exception(e, lookup_lines=False, capture_locals=False)}
+            duration_ns = time.perf_counter_ns() - start_time if debug_enabled else 0
+            debug_record = DebugRecord(step_name, step_type, "Failed", duration_ns, record_inputs or {"error": "Could not resolve inputs before failure."}, {}, error=error_details)
             return {"debug_log": [debug_record], "error_info": [{"failed_step": step_name, **error_details}]}
     return wrapped_node
 
+# Maps each step type to the builder of its logic; new step types register here.
+LOGIC_BUILDERS: Dict[str, Callable] = {
+    'llm': _build_llm_logic, 'code': _build_code_logic,
+    'api': _build_api_logic, 'workflow': _build_workflow_logic
+}
+
 def create_node_function(resources, workflow_package_path, step_name, step_type, params):
-    logic_map = {
-        'llm': _llm_logic, 'code': _code_logic,
-        'api': _api_logic, 'workflow': _workflow_logic
-    }
-    if step_type not in logic_map:
+    builder = LOGIC_BUILDERS.get(step_type)
+    if builder is None:
         raise ValueError(f"Unknown step type: {step_type}")
 
-    async def logic_caller(item: Optional[Any], context_data: Dict[str, Any]):
-        return await logic_map[step_type](resources, workflow_package_path, step_name, params, context_data)
-        
-    return _node_wrapper(step_name, step_type, params, logic_caller)
\ No newline at end of file
+    # The step's constant configuration is bound once here, not on every call.
+    logic_func = builder(resources, workflow_package_path, step_name, params)
+    return _node_wrapper(step_name, step_type, params, logic_func, resources.debug_enabled)
\ No newline at end of file
@@ -1,75 +1,239 @@
-import json
-import httpx
-import yaml
-from typing import Dict, Any
+import asyncio
+import hashlib
+import inspect
+import orjson
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Awaitable, Optional
 
 from .pipeline.resource_provider import ResourceProvider
-from src.llm_integration.prompt_loader import load_prompt_template
+from src.llm_integration.prompt_loader import compile_prompt_template, render_prompt_template
 from src.custom_code import CODE_STEP_REGISTRY
-from .graph_types import _resolve_value_from_state, _resolve_placeholders
+from .graph_types import _compile_input_mapping, _compile_key, _compile_placeholders, sanitize_for_json, DebugRecord
 
-# Note: The 'index' parameter is reserved for future use with sub-workflow mapping.
-async def _llm_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any], context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
-    resolved_inputs = {p: _resolve_value_from_state(context_data, sk) for p, sk in params.get('input_mapping', {}).items()}
+# Each builder runs once per step at graph-build time and returns the coroutine
+# executed on every invocation, so per-step constants are prepared only once.
+LogicFunc = Callable[[Dict[str, Any]], Awaitable[tuple[Any, Dict, list]]]
+
+# Results of llm, code and workflow steps with `cache_policy: by_hash`, keyed by
+# a hash of the step's identity and its fully resolved inputs. The cache lives
+# as long as the server process, so only the most recently used entries are kept.
+_NODE_RESULT_CACHE: "OrderedDict[str, Any]" = OrderedDict()
+MAX_CACHED_RESULTS = 1024
+_CACHE_MISS = object()
+
+# Sub-workflow events are forwarded in batches of at most this many events, or
+# after this many seconds; a node starting or ending flushes at once.
+SUB_EVENT_BATCH_SIZE = 64
+SUB_EVENT_FLUSH_INTERVAL_S = 0.05
+
+def _hash_default(value: Any) -> str:
+    """Hashes binary values instead of embedding them in the cache key."""
+    if isinstance(value, bytes): return "bytes:" + hashlib.sha256(value).hexdigest()
+    return str(value)
+
+def _result_cache_key(*parts: Any) -> str:
+    """Builds a content-addressed cache key from canonical JSON of the given parts."""
+    canonical = orjson.dumps(parts, default=_hash_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return hashlib.sha256(canonical).hexdigest()
+
+def _cache_get(cache_key: Optional[str]) -> Any:
+    """Returns the cached result for the key, or _CACHE_MISS; a hit becomes the most recently used entry."""
+    if cache_key is None: return _CACHE_MISS
+    output = _NODE_RESULT_CACHE.get(cache_key, _CACHE_MISS)
+    if output is not _CACHE_MISS: _NODE_RESULT_CACHE.move_to_end(cache_key)
+    return output
+
+def _cache_put(cache_key: Optional[str], output: Any) -> None:
+    """Stores a result, evicting the least recently used entries beyond MAX_CACHED_RESULTS."""
+    if cache_key is None: return
+    _NODE_RESULT_CACHE[cache_key] = output
+    _NODE_RESULT_CACHE.move_to_end(cache_key)
+    while len(_NODE_RESULT_CACHE) > MAX_CACHED_RESULTS: _NODE_RESULT_CACHE.popitem(last=False)
+
+def _cache_hit_label(step_name: str, map_index: Optional[int]) -> str:
+    """Names the child record of a cache hit; mapped runs look it up by this name."""
+    return f"{step_name} [Cache hit]" if map_index is None else f"{step_name} [Cache hit, Run {map_index + 1}]"
+
+def _cache_hit_logs(resources: ResourceProvider, step_name: str, step_type: str, context_data: Dict[str, Any], inputs: Dict[str, Any], output: Any) -> list:
+    """
+    Returns the child record showing that a step's result was served from the
+    cache, without a call. For a mapped item the step wrapper folds it into
+    that item's own run record.
+    """
+    if not resources.debug_enabled: return []
+    label = _cache_hit_label(step_name, context_data.get("map_index"))
+    return [DebugRecord(label, f"cached_{step_type}", "Cached", 0, sanitize_for_json(inputs), output, is_child=True)]
+
+async def _call_gemini(resources: ResourceProvider, prompt_content: Any, call_name: str) -> Dict[str, Any]:
+    """Calls Gemini while holding one of the run's bounded LLM permits."""
+    async with resources.llm_slot():
+        return await resources.get_gemini_client().call_gemini_async(prompt_content, call_name)
+
+def _render_prompt_content(prompt_segments: tuple, prompt_template: str, resolved_inputs: Dict[str, Any]) -> Any:
+    """
+    Renders the text prompt from the resolved inputs. Binary attachments, if
+    any, follow the text in a list; otherwise the text is sent on its own.
+    """
     if all(v is None for v in resolved_inputs.values()): raise ValueError("All resolved inputs for LLM node are None.")
-    prompt_content, p_inputs = [], {}
+    attachments, p_inputs = [], {}
     for key, value in resolved_inputs.items():
-        if isinstance(value, dict) and 'mime_type' in value and 'data' in value: prompt_content.append(value)
-        else: p_inputs[key] = json.dumps(value, indent=2) if isinstance(value, (dict, list)) else value
-    text_prompt = load_prompt_template(params['prompt_template'], p_inputs, workflow_package_path)
-    prompt_content.insert(0, text_prompt)
-    result = await resources.get_gemini_client().call_gemini_async(prompt_content, step_name)
-    output = result.get('response_json', {})
-    return output, resolved_inputs, []
-
-async def _code_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any], context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
-    resolved_inputs = {mf: _resolve_value_from_state(context_data, sk) for mf, sk in params.get('input_mapping', {}).items()}
-    StepClass = CODE_STEP_REGISTRY[params['function_name']]
-    validated_input = StepClass.InputModel.model_validate(resolved_inputs)
-    step_instance = StepClass(resources)
-    output_model = await step_instance.execute(validated_input)
-    output = output_model.model_dump()
-    return output, resolved_inputs, []
-
-async def _api_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any], context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
-    resolved_endpoint = _resolve_placeholders(params.get('endpoint', ''), context_data)
-    resolved_headers = _resolve_placeholders(params.get('headers', {}), context_data)
-    resolved_body = _resolve_placeholders(params.get('body', {}), context_data)
+        if isinstance(value, dict) and 'mime_type' in value and 'data' in value: attachments.append(value)
+        else: p_inputs[key] = orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode() if isinstance(value, (dict, list)) else value
+    text_prompt = render_prompt_template(prompt_segments, p_inputs, prompt_template)
+    return [text_prompt, *attachments] if attachments else text_prompt
+
+def _build_llm_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any]) -> LogicFunc:
+    if params.get('parallel_prompts'):
+        return _build_parallel_llm_logic(resources, workflow_package_path, step_name, params)
+    input_resolvers = _compile_input_mapping(params.get('input_mapping', {}))
+    prompt_template = params['prompt_template']
+    # The template is located and parsed here once; each call only substitutes.
+    prompt_segments = compile_prompt_template(prompt_template, workflow_package_path)
+    use_cache = params.get('cache_policy') == 'by_hash'
+
+    async def llm_logic(context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
+        resolved_inputs = {p: resolve(context_data) for p, resolve in input_resolvers}
+        prompt_content = _render_prompt_content(prompt_segments, prompt_template, resolved_inputs)
+        # Keyed on the rendered prompt, so edits to the template invalidate the entry.
+        cache_key = _result_cache_key(str(workflow_package_path), step_name, prompt_content) if use_cache else None
+        cached = _cache_get(cache_key)
+        if cached is not _CACHE_MISS: return cached, resolved_inputs, _cache_hit_logs(resources, step_name, "llm", context_data, resolved_inputs, cached)
+        result = await _call_gemini(resources, prompt_content, step_name)
+        output = result.get('response_json', {})
+        _cache_put(cache_key, output)
+        return output, resolved_inputs, []
+    return llm_logic
+
+def _build_parallel_llm_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any]) -> LogicFunc:
+    """
+    Builds an LLM step that sends several independent prompts concurrently. The
+    step's output is the list of responses, in the order the prompts are declared.
+    With `cache_policy: by_hash`, each prompt is cached on its own rendered text.
+    """
+    prompts = tuple(
+        (p['prompt_template'], compile_prompt_template(p['prompt_template'], workflow_package_path), _compile_input_mapping(p.get('input_mapping', {})))
+        for p in params['parallel_prompts']
+    )
+    use_cache = params.get('cache_policy') == 'by_hash'
+
+    async def parallel_llm_logic(context_data: Dict[str, Any]) -> tuple[list, Dict, list]:
+        all_inputs, prompt_contents = [], []
+        for prompt_template, prompt_segments, input_resolvers in prompts:
+            resolved_inputs = {p: resolve(context_data) for p, resolve in input_resolvers}
+            all_inputs.append(resolved_inputs)
+            prompt_contents.append(_render_prompt_content(prompt_segments, prompt_template, resolved_inputs))
+
+        cache_keys = [_result_cache_key(str(workflow_package_path), f"{step_name}#{i}", pc) if use_cache else None for i, pc in enumerate(prompt_contents)]
+        outputs = [_cache_get(cache_key) for cache_key in cache_keys]
+        pending = [i for i, output in enumerate(outputs) if output is _CACHE_MISS]
+        # Every call is allowed to finish before the first failure is surfaced.
+        results = await asyncio.gather(*(_call_gemini(resources, prompt_contents[i], f"{step_name}#{i}") for i in pending), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException): raise result
+        for i, result in zip(pending, results):
+            outputs[i] = result.get('response_json', {})
+            _cache_put(cache_keys[i], outputs[i])
+
+        if not resources.debug_enabled: return outputs, {"parallel_prompts": all_inputs}, []
+        called = set(pending)
+        child_records = [
+            DebugRecord(f"{step_name} [Prompt {i+1}/{len(prompts)}: {prompts[i][0]}]", "parallel_llm", "Completed" if i in called else "Cached", 0, sanitize_for_json(all_inputs[i]), output, is_child=True)
+            for i, output in enumerate(outputs)
+        ]
+        return outputs, {"parallel_prompts": all_inputs}, child_records
+    return parallel_llm_logic
+
+def _build_code_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any]) -> LogicFunc:
+    input_resolvers = _compile_input_mapping(params.get('input_mapping', {}))
+    function_name = params['function_name']
+    # The step class is resolved once, so an unknown function fails the build.
+    if function_name not in CODE_STEP_REGISTRY: raise ValueError(f"Custom code step '{function_name}' is not registered.")
+    StepClass = CODE_STEP_REGISTRY[function_name]
+    # Inputs produced by earlier in-graph steps can skip pydantic validation.
+    # Otherwise the models' core validator and serializer are bound once here,
+    # the same calls model_validate and model_dump make on every invocation.
+    if params.get('trusted_input'): build_input = lambda data: StepClass.InputModel.model_construct(**data)
+    else: build_input = StepClass.InputModel.__pydantic_validator__.validate_python
+    dump_output = StepClass.OutputModel.__pydantic_serializer__.to_python
+    use_cache = params.get('cache_policy') == 'by_hash'
+    # Steps with a plain `def execute` are called directly, without a coroutine.
+    execute_is_async = inspect.iscoroutinefunction(StepClass.execute)
+    shared_instance = None if getattr(StepClass, 'PER_CALL_STATE', False) else StepClass(resources)
+
+    async def code_logic(context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
+        resolved_inputs = {mf: resolve(context_data) for mf, resolve in input_resolvers}
+        cache_key = _result_cache_key(function_name, resolved_inputs) if use_cache else None
+        cached = _cache_get(cache_key)
+        if cached is not _CACHE_MISS: return cached, resolved_inputs, _cache_hit_logs(resources, step_name, "code", context_data, resolved_inputs, cached)
+        validated_input = build_input(resolved_inputs)
+        step_instance = shared_instance if shared_instance is not None else StepClass(resources)
+        output_model = await step_instance.execute(validated_input) if execute_is_async else step_instance.execute(validated_input)
+        output = dump_output(output_model)
+        _cache_put(cache_key, output)
+        return output, resolved_inputs, []
+    return code_logic
+
+def _build_api_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any]) -> LogicFunc:
+    endpoint, headers, body = params.get('endpoint', ''), params.get('headers', {}), params.get('body', {})
     method = params.get('method', 'GET').upper()
-    async with httpx.AsyncClient() as client:
-        response = await client.request(method=method, url=resolved_endpoint, headers=resolved_headers, json=resolved_body if method in ["POST", "PUT"] else None)
+    # Placeholders are located once here; fields without any are used as-is on every call.
+    resolve_endpoint, resolve_headers, resolve_body = (_compile_placeholders(value) for value in (endpoint, headers, body))
+
+    async def api_logic(context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
+        resolved_endpoint = resolve_endpoint(context_data) if resolve_endpoint else endpoint
+        resolved_headers = resolve_headers(context_data) if resolve_headers else headers
+        resolved_body = resolve_body(context_data) if resolve_body else body
+        response = await resources.get_http_client().request(method=method, url=resolved_endpoint, headers=resolved_headers, json=resolved_body if method in ["POST", "PUT"] else None)
         response.raise_for_status()
         output = response.json()
-    return output, {"method": method, "endpoint": resolved_endpoint, "headers": resolved_headers, "body": resolved_body}, []
+        return output, {"method": method, "endpoint": resolved_endpoint, "headers": resolved_headers, "body": resolved_body}, []
+    return api_logic
 
-async def _workflow_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any], context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
-    from .langgraph_builder import LangGraphBuilder, COMPILED_WORKFLOW_CACHE # Local import to avoid top-level circular dependency
+def _build_workflow_logic(resources: ResourceProvider, workflow_package_path, step_name: str, params: Dict[str, Any]) -> LogicFunc:
     sub_workflow_name = params['workflow_name']
-    input_mapping = params.get('input_mapping', {})
-    sub_initial_data = {sub_key: _resolve_value_from_state(context_data, parent_key) for parent_key, sub_key in input_mapping.items()}
-    sub_initial_state = {"workflow_data": sub_initial_data}
-    
-    if sub_workflow_name in COMPILED_WORKFLOW_CACHE:
-        sub_graph = COMPILED_WORKFLOW_CACHE[sub_workflow_name]
-    else:
-        sub_workflow_path = workflow_package_path.parent / sub_workflow_name / "workflow.yaml"
-        if not sub_workflow_path.exists(): raise FileNotFoundError(f"Sub-workflow package '{sub_workflow_name}' not found at: {sub_workflow_path}")
-        with open(sub_workflow_path, 'r') as f: sub_workflow_dict = yaml.safe_load(f)
-        builder = LangGraphBuilder(sub_workflow_dict, resources, sub_workflow_path)
-        sub_graph = builder.build()
-        COMPILED_WORKFLOW_CACHE[sub_workflow_name] = sub_graph
-    
-    map_index = context_data.get("map_index")
-    async for event in sub_graph.astream_events(sub_initial_state, version="v1"):
-        await resources.emit_event({"type": "sub_workflow_event", "data": {"parent_step": step_name, "sub_workflow": sub_workflow_name, "original_event": event, "map_index": map_index}})
-    
-    final_sub_state = await sub_graph.ainvoke(sub_initial_state)
-    if final_sub_state.get("error_info"):
-        sub_error = final_sub_state["error_info"][0]
-        raise RuntimeError(f"Sub-workflow '{sub_workflow_name}' failed at step '{sub_error.get('failed_step')}': {sub_error.get('message')}")
-    
-    output_mapping = params.get('output_mapping', {})
-    sub_workflow_data = final_sub_state.get("workflow_data", {})
-    parent_outputs = {parent_key: sub_workflow_data.get(sub_key) for sub_key, parent_key in output_mapping.items()}
-    additional_logs = final_sub_state.get("debug_log", [])
-    return parent_outputs, sub_initial_data, additional_logs
\ No newline at end of file
+    # Workflow input mappings are {parent_key: sub_key}, so the resolver is keyed by sub_key.
+    input_resolvers = tuple((sub_key, _compile_key(parent_key)) for parent_key, sub_key in params.get('input_mapping', {}).items())
+    output_items = tuple(params.get('output_mapping', {}).items())
+    use_cache = params.get('cache_policy') == 'by_hash'
+
+    # Local import to avoid top-level circular dependency. The sub-workflow is
+    # compiled here, while the parent graph is built, so no call pays for it.
+    from .langgraph_builder import compile_sub_workflow
+    sub_graph, sub_workflow_digest = compile_sub_workflow(resources, workflow_package_path, sub_workflow_name)
+    sub_node_names = frozenset(sub_graph.nodes)
+
+    async def workflow_logic(context_data: Dict[str, Any]) -> tuple[Dict, Dict, list]:
+        sub_initial_data = {sub_key: resolve(context_data) for sub_key, resolve in input_resolvers}
+        sub_initial_state = {"workflow_data": sub_initial_data}
+        cache_key = _result_cache_key(sub_workflow_name, sub_workflow_digest, sub_initial_data) if use_cache else None
+        cached = _cache_get(cache_key)
+        if cached is not _CACHE_MISS: return cached, sub_initial_data, _cache_hit_logs(resources, step_name, "workflow", context_data, sub_initial_data, cached)
+        
+        map_index = context_data.get("map_index")
+        # The sub-workflow runs once: its final state is the output of the root
+        # run's on_chain_end event, the first event's run_id identifying the root.
+        root_run_id, final_sub_state = None, None
+        loop = asyncio.get_running_loop()
+        batch, last_flush = [], loop.time()
+        async for event in sub_graph.astream_events(sub_initial_state, version="v1"):
+            if root_run_id is None: root_run_id = event["run_id"]
+            elif event["event"] == "on_chain_end" and event["run_id"] == root_run_id: final_sub_state = event["data"].get("output")
+            batch.append({"type": "sub_workflow_event", "data": {"parent_step": step_name, "sub_workflow": sub_workflow_name, "original_event": event, "map_index": map_index}})
+            # Node starts and ends are flushed right away, so the live sub-DAG never lags behind a running step.
+            is_node_boundary = event["name"] in sub_node_names and event["event"] in ("on_chain_start", "on_chain_end")
+            if is_node_boundary or len(batch) >= SUB_EVENT_BATCH_SIZE or loop.time() - last_flush >= SUB_EVENT_FLUSH_INTERVAL_S:
+                await resources.emit_events_batch(batch)
+                batch, last_flush = [], loop.time()
+        if batch: await resources.emit_events_batch(batch)
+
+        if not isinstance(final_sub_state, dict): raise RuntimeError(f"Sub-workflow '{sub_workflow_name}' finished without a final state.")
+        if final_sub_state.get("error_info"):
+            sub_error = final_sub_state["error_info"][0]
+            raise RuntimeError(f"Sub-workflow '{sub_workflow_name}' failed at step '{sub_error.get('failed_step')}': {sub_error.get('message')}")
+        
+        sub_workflow_data = final_sub_state.get("workflow_data", {})
+        parent_outputs = {parent_key: sub_workflow_data.get(sub_key) for sub_key, parent_key in output_items}
+        _cache_put(cache_key, parent_outputs)
+        additional_logs = final_sub_state.get("debug_log", [])
+        return parent_outputs, sub_initial_data, additional_logs
+    return workflow_logic
\ No newline at end of file
@@ -1,21 +1,45 @@
 from __future__ import annotations
 import asyncio
-from typing import TYPE_CHECKING, Optional, Dict, Any
+import httpx
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, AsyncIterator
 
 from src.data_layer.database_manager import DatabaseManager
 
 if TYPE_CHECKING:
     from src.llm_integration.gemini_client import GeminiClient
 
+class RunResources:
+    """Resources owned by a single workflow run, released when the run ends."""
+    def __init__(self, llm_semaphore: asyncio.Semaphore):
+        self.llm_semaphore = llm_semaphore
+        self.http_client: Optional[httpx.AsyncClient] = None
+
+    async def aclose(self) -> None:
+        """Closes the run's HTTP client, if one was created."""
+        if self.http_client is not None:
+            client, self.http_client = self.http_client, None
+            await client.aclose()
+
+# The resources of the run the current task belongs to. Tasks copy their context
+# when they are created, so every node of a run sees that run's resources, while
+# concurrent runs sharing one cached ResourceProvider never see each other's.
+_CURRENT_RUN: ContextVar[Optional[RunResources]] = ContextVar("current_run", default=None)
+
 class ResourceProvider:
     """
     A container for stateful resources. It now includes an event queue for
     streaming real-time updates from nested workflow executions.
     """
-    def __init__(self, db_manager: DatabaseManager):
+    def __init__(self, db_manager: DatabaseManager, max_concurrent_llm: int = 32, llm_batch_delay_s: float = 0.0, debug_enabled: bool = True):
         self._db_manager = db_manager
+        # When disabled, steps skip capturing inputs and per-item child records.
+        self.debug_enabled = debug_enabled
         self._gemini_client: GeminiClient | None = None
         self._event_queue: Optional[asyncio.Queue] = None
+        self._max_concurrent_llm = max_concurrent_llm
+        self._llm_batch_delay_s = llm_batch_delay_s
 
     def set_gemini_client(self, client: GeminiClient) -> None:
         """Sets the Gemini client for the current run."""
@@ -25,11 +49,51 @@ class ResourceProvider:
         """Sets the event queue for the current run."""
         self._event_queue = queue
 
+    @asynccontextmanager
+    async def llm_slot(self) -> AsyncIterator[None]:
+        """
+        Holds one of the run's LLM permits for the duration of a call. The
+        optional batch delay is observed before the permit is released.
+        """
+        async with self._current_run().llm_semaphore:
+            yield
+            if self._llm_batch_delay_s: await asyncio.sleep(self._llm_batch_delay_s)
+
+    def new_run_resources(self) -> RunResources:
+        """
+        Creates the resources of a new run, including its own LLM concurrency
+        limiter; the caller closes them when the run ends.
+        """
+        return RunResources(asyncio.Semaphore(self._max_concurrent_llm))
+
+    def bind_run(self, run_resources: RunResources) -> None:
+        """Makes the run's resources visible to the current task and every task it starts."""
+        _CURRENT_RUN.set(run_resources)
+
+    def _current_run(self) -> RunResources:
+        """Returns the resources of the run the current task belongs to."""
+        run_resources = _CURRENT_RUN.get()
+        if run_resources is None:
+            raise ValueError("Run resources not initialized for this run.")
+        return run_resources
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        """Returns the run's shared, connection-pooling HTTP client, creating it on first use."""
+        run_resources = self._current_run()
+        if run_resources.http_client is None:
+            run_resources.http_client = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=100, max_connections=200))
+        return run_resources.http_client
+
     async def emit_event(self, event: Dict[str, Any]) -> None:
         """Emits an event to the orchestrator's queue if it exists."""
         if self._event_queue:
             await self._event_queue.put(event)
 
+    async def emit_events_batch(self, events: List[Dict[str, Any]]) -> None:
+        """Emits several events as a single queue item, in order."""
+        if self._event_queue and events:
+            await self._event_queue.put(events)
+
     def get_db_manager(self) -> DatabaseManager:
         """Returns the cached database manager."""
         return self._db_manager
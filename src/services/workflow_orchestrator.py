@@ -5,13 +5,27 @@ import asyncio
 import uuid
 from datetime import datetime
 import time
+import traceback
 
 from src.llm_integration.gemini_client import GeminiClient
-from src.services.langgraph_builder import LangGraphBuilder
+from src.services.langgraph_builder import compile_workflow
+from src.services.graph_types import sanitize_for_json, _contains_bytes, apply_state_update, empty_state
 
 if TYPE_CHECKING:
     from src.services.pipeline.resource_provider import ResourceProvider
 
+def _displayable_error(error: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the error details with their captured traceback formatted as text."""
+    captured = error.get("traceback")
+    if isinstance(captured, traceback.TracebackException): return {**error, "traceback": "".join(captured.format())}
+    return error
+
+def _displayable_record(record) -> Dict[str, Any]:
+    """Converts a DebugRecord into a sanitized dict with its traceback, if any, formatted."""
+    record_data = record.to_dict()
+    if "error" in record_data: record_data["error"] = _displayable_error(record_data["error"])
+    return sanitize_for_json(record_data)
+
 async def run_workflow_streaming(
     resources: ResourceProvider, 
     workflow_def: dict, 
@@ -24,30 +38,93 @@ async def run_workflow_streaming(
     """
     gemini_client = GeminiClient()
     resources.set_gemini_client(gemini_client)
+    # Created per run: the ResourceProvider itself is shared by every session.
+    run_resources = resources.new_run_resources()
     
     event_queue = asyncio.Queue()
     resources.set_event_queue(event_queue)
 
-    graph = LangGraphBuilder(workflow_def, resources, workflow_path).build()
-    
     merged_stream_queue = asyncio.Queue()
+    # Routers write nothing yet did run, unlike steps skipped after an upstream failure.
+    router_names = frozenset(step['name'] for step in workflow_def.get('steps', []) if step.get('type') == 'conditional_router')
 
     async def stream_graph_events():
-        async for event in graph.astream_events(initial_state, version="v1"):
-            await merged_stream_queue.put({"source": "graph", "payload": event})
+        # Bound in this task's own context, which every node task of the run inherits.
+        resources.bind_run(run_resources)
+        # Only per-node task starts and per-node updates are streamed. The full
+        # state is never materialized per step: the final state is rebuilt by
+        # folding the input and every update through the state's reducers.
+        final_state = empty_state()
+        apply_state_update(final_state, initial_state)
+        async for mode, chunk in graph.astream(initial_state, stream_mode=["tasks", "updates"]):
+            if mode == "tasks":
+                # Task results arrive in the updates stream; only starts carry "input".
+                if "input" in chunk:
+                    await merged_stream_queue.put({"source": "graph", "payload": {"type": "lifecycle_update", "data": {"step_name": chunk["name"], "status": "RUNNING"}}})
+            elif mode == "updates":
+                for step_name, node_output in chunk.items():
+                    if not isinstance(node_output, dict): node_output = {}
+                    apply_state_update(final_state, node_output)
+                    if node_output.get("debug_log"):
+                        # Inputs reach the record raw; they are made displayable here, so
+                        # nodes never pay for sanitization. Only inputs that actually hold
+                        # bytes are copied, in a worker thread; the rest are used as-is.
+                        step_record, *other_records = node_output["debug_log"]
+                        timestamp = time.time()
+                        log_data = {**step_record.to_dict(), "timestamp": timestamp}
+                        if _contains_bytes(log_data["inputs"]):
+                            log_data["inputs"] = await asyncio.to_thread(sanitize_for_json, log_data["inputs"])
+                        if "error" in log_data: log_data["error"] = _displayable_error(log_data["error"])
+                        await merged_stream_queue.put({"source": "graph", "payload": {"type": "log", "data": log_data}})
+                        # The step's child records (mapped runs, parallel prompts, cache hits)
+                        # follow it; their inputs are sanitized when they are built.
+                        for record in other_records:
+                            if record.is_child:
+                                await merged_stream_queue.put({"source": "graph", "payload": {"type": "log", "data": {**record.to_dict(), "timestamp": timestamp}}})
+                    # Steps skipped by the fail-fast check return an empty update and stay PENDING.
+                    if node_output.get("error_info"): status = "FAILED"
+                    elif step_name in router_names or "workflow_data" in node_output or "debug_log" in node_output: status = "COMPLETED"
+                    else: continue
+                    await merged_stream_queue.put({"source": "graph", "payload": {"type": "lifecycle_update", "data": {"step_name": step_name, "status": status}}})
+        # The UI keeps the final state and shows it as JSON, so its records are
+        # yielded as plain, sanitized dicts rather than DebugRecord instances,
+        # and every captured traceback is formatted.
+        records = final_state["debug_log"]
+        final_state = {
+            **final_state,
+            "debug_log": await asyncio.to_thread(lambda: [_displayable_record(record) for record in records]),
+            "error_info": [_displayable_error(error) for error in final_state["error_info"]],
+        }
+        await merged_stream_queue.put({"source": "graph", "payload": {"type": "result", "data": final_state}})
         await merged_stream_queue.put(None)
 
     async def stream_sub_workflow_events():
         while True:
             event = await event_queue.get()
             if event is None: break
-            await merged_stream_queue.put({"source": "sub_workflow", "payload": event})
+            # Batches from emit_events_batch stay a single item until they are yielded.
+            if isinstance(event, list): await merged_stream_queue.put({"source": "sub_workflow", "payloads": event})
+            else: await merged_stream_queue.put({"source": "sub_workflow", "payload": event})
             event_queue.task_done()
 
-    graph_task = asyncio.create_task(stream_graph_events())
-    sub_workflow_task = asyncio.create_task(stream_sub_workflow_events())
-
+    graph_task, sub_workflow_task = None, None
     try:
+        # Building reads prompt and sub-workflow YAML files from disk, so it runs
+        # in a worker thread to keep the event loop free. Unchanged workflows reuse
+        # the graph compiled by an earlier run.
+        try:
+            graph = await asyncio.to_thread(compile_workflow, resources, workflow_def, workflow_path)
+        except Exception as e:
+            # A missing prompt, sub-workflow or custom function fails the build; it
+            # is reported like a failed step rather than raised out of the run.
+            error_details = {"message": str(e), "traceback": traceback.format_exc()}
+            yield {"type": "log", "data": {"step_name": "workflow_build", "type": "build", "status": "Failed", "duration_ns": 0, "inputs": {}, "outputs": {}, "error": error_details, "timestamp": time.time()}}
+            yield {"type": "result", "data": {**initial_state, "error_info": [{"failed_step": "workflow_build", **error_details}]}}
+            return
+
+        graph_task = asyncio.create_task(stream_graph_events())
+        sub_workflow_task = asyncio.create_task(stream_sub_workflow_events())
+
         stop_count = 0
         while stop_count < 1:
             event_wrapper = await merged_stream_queue.get()
@@ -55,28 +132,12 @@ async def run_workflow_streaming(
                 stop_count += 1
                 continue
 
-            source, payload = event_wrapper["source"], event_wrapper["payload"]
-
-            if source == "graph":
-                event_name = payload["event"]
-                if event_name == "on_chain_start" and payload["name"] != "__root__":
-                    yield {"type": "lifecycle_update", "data": {"step_name": payload["name"], "status": "RUNNING"}}
-                
-                elif event_name == "on_chain_end":
-                    node_output = payload["data"].get("output")
-                    if isinstance(node_output, dict) and "debug_log" in node_output and node_output["debug_log"]:
-                        log_data = node_output["debug_log"][0]
-                        log_data['timestamp'] = time.time()
-                        yield {"type": "log", "data": log_data}
-                        yield {"type": "lifecycle_update", "data": {"step_name": log_data["step_name"], "status": log_data["status"].upper()}}
-                
-                elif event_name == "on_graph_end":
-                    final_state = payload["data"].get("output")
-                    yield {"type": "result", "data": final_state}
-                    # No longer saving to DB, so this part is clean.
-            
-            elif source == "sub_workflow":
-                yield payload
+            # Graph events are already translated by the producer; sub-workflow
+            # events are forwarded as emitted, batches one event at a time.
+            if "payloads" in event_wrapper:
+                for payload in event_wrapper["payloads"]: yield payload
+            else:
+                yield event_wrapper["payload"]
     
     finally:
         # --- THIS IS THE DEFINITIVE FIX ---
@@ -85,10 +146,13 @@ async def run_workflow_streaming(
         # 1. Stop the sub_workflow listener gracefully.
         await event_queue.put(None)
         
-        # 2. Cancel the main tasks.
-        graph_task.cancel()
-        sub_workflow_task.cancel()
+        # 2. Cancel the main tasks, if the build got far enough to start them.
+        tasks = [task for task in (graph_task, sub_workflow_task) if task is not None]
+        for task in tasks: task.cancel()
         
         # 3. Wait for them to acknowledge the cancellation.
         # return_exceptions=True prevents errors from being raised if a task is already finished.
-        await asyncio.gather(graph_task, sub_workflow_task, return_exceptions=True)
\ No newline at end of file
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # 4. Release the run's pooled HTTP connections.
+        await run_resources.aclose()
\ No newline at end of file